@@ -1,25 +1,42 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_socketio import SocketIO
 from flask_socketio import join_room, leave_room, emit
 from flask_cors import CORS
 from flask_pymongo import PyMongo
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import os
 from os import getenv
 from flask_jwt_extended import (
     JWTManager, create_access_token, create_refresh_token,
-    jwt_required, get_jwt_identity, decode_token
+    jwt_required, get_jwt_identity, decode_token, verify_jwt_in_request
 )
 from flask_bcrypt import Bcrypt
 from sumy.parsers.plaintext import PlaintextParser
 from sumy.nlp.tokenizers import Tokenizer
 from sumy.summarizers.text_rank import TextRankSummarizer
 import re
+from html import unescape
+import io
+import csv
+import json
+import zipfile
 from werkzeug.utils import secure_filename
 import nltk
-from collections import defaultdict
+import collab_codec
+from collections import defaultdict, Counter
+import difflib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import threading
+import time
+import math
+from functools import wraps
+import cProfile
+import sys
 
 # Try to load environment variables from a .env file if available
 try:
@@ -28,19 +45,48 @@ try:
 except Exception:
     pass
 
+# ---------- query timing ----------
+# Records Mongo command durations for the current request/socket handler so slow
+# ones can be logged with a per-query breakdown. Tracing is only active while
+# _query_trace.calls is a list; otherwise the listener does nothing.
+_query_trace = threading.local()
+
+
+class QueryTimer(monitoring.CommandListener):
+    def started(self, event):
+        if getattr(_query_trace, "calls", None) is not None:
+            _query_trace.pending[event.request_id] = event.command.get(event.command_name)
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        calls = getattr(_query_trace, "calls", None)
+        if calls is None:
+            return
+        collection = _query_trace.pending.pop(event.request_id, None)
+        target = f"{event.command_name} {collection}" if isinstance(collection, str) else event.command_name
+        calls.append((target, event.duration_micros / 1000.0))
+
+
 # -----------------------------------------
 # INITIAL SETUP
 # -----------------------------------------
 app = Flask(__name__)
-CORS(app, supports_credentials=True)
+CORS(app, supports_credentials=True, expose_headers=["Retry-After", "X-Profile-File"])
 
 app.config["MONGO_URI"] = getenv("MONGO_URI", "mongodb://localhost:27017/document_collab")
-mongo = PyMongo(app)
+mongo = PyMongo(app, event_listeners=[QueryTimer()])
 
 app.config['SECRET_KEY'] = getenv('SECRET_KEY', 'supersecretkey')
 app.config['JWT_SECRET_KEY'] = getenv('JWT_SECRET_KEY', 'supersecurejwtkey')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=int(getenv('JWT_ACCESS_HOURS', '2')))
 app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=int(getenv('JWT_REFRESH_DAYS', '7')))
+# bcrypt cost factor (read by Flask-Bcrypt at init time)
+app.config['BCRYPT_LOG_ROUNDS'] = int(getenv('BCRYPT_LOG_ROUNDS', '12'))
 
 socketio = SocketIO(app, cors_allowed_origins="*")
 jwt = JWTManager(app)
@@ -54,13 +100,430 @@ def serialize_doc(doc):
     return {
         "id": str(doc["_id"]),
         "title": doc.get("title", ""),
-        "content": doc.get("content", ""),
+        "content": doc_content(doc),
+        "block_ids": [b.get("id") for b in doc.get("blocks") or []],
         "updated_at": dt_to_iso(doc.get("updated_at")),
         "created_at": dt_to_iso(doc.get("created_at")),
         "owner_email": doc.get("owner_email"),
     }
 
 
+def word_count(txt):
+    try:
+        return len((txt or "").split())
+    except Exception:
+        return 0
+
+def parse_iso_utc(value):
+    """Parse an ISO timestamp (or datetime) into a naive UTC datetime as stored by Mongo."""
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, str) and value.strip():
+        try:
+            dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    else:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    # Mongo keeps millisecond precision only
+    return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
+_DATE_ONLY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def date_range_filter(tz=timezone.utc):
+    """Mongo range for the ?from=&to= params, read in timezone `tz`.
+
+    Date-only values cover whole local days: from=2026-10-19 starts at local
+    midnight and to=2026-10-19 runs up to (not including) the next local
+    midnight. Timestamps without an offset are taken as local time in `tz`.
+    Returns (range_dict, error_message).
+    """
+    date_range = {}
+    for param in ("from", "to"):
+        raw = (request.args.get(param) or "").strip()
+        if not raw:
+            continue
+        try:
+            parsed = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+        except ValueError:
+            return None, f"Invalid '{param}' date"
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=tz)
+        if param == "from":
+            date_range["$gte"] = parse_iso_utc(parsed)
+        elif _DATE_ONLY_RE.match(raw):
+            # Add the day on the local calendar so DST days are 23/25 hours
+            next_day = parsed.date() + timedelta(days=1)
+            end = datetime(next_day.year, next_day.month, next_day.day, tzinfo=tz)
+            date_range["$lt"] = parse_iso_utc(end)
+        else:
+            date_range["$lte"] = parse_iso_utc(parsed)
+    return date_range, None
+
+
+# ---------- block storage helpers ----------
+# Document bodies are stored as an ordered list of blocks with stable ids, so
+# edits can target individual blocks instead of rewriting the whole document.
+# The editor saves TipTap HTML, where a block is one top-level element (<p>,
+# <h2>, a whole <ul>, ...); plain-text bodies (legacy/uploads) use one block per
+# line. `block_format` records which split was used so the body reassembles
+# exactly. Older documents still carrying a single `content` string are
+# converted the first time they are opened or patched.
+BLOCK_FORMAT_TEXT = "text"
+BLOCK_FORMAT_HTML = "html"
+
+_VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "source", "track", "wbr",
+}
+_TAG_RE = re.compile(
+    r"<!--.*?-->|<(/?)([a-zA-Z][\w:-]*)((?:\"[^\"]*\"|'[^']*'|[^'\">])*)>", re.S
+)
+
+def new_block_id():
+    return str(ObjectId())
+
+def content_format(content):
+    """HTML for editor output (and empty bodies, which the editor fills), text otherwise."""
+    stripped = (content or "").lstrip()
+    return BLOCK_FORMAT_HTML if not stripped or stripped.startswith("<") else BLOCK_FORMAT_TEXT
+
+def split_html_blocks(html):
+    """Split HTML into its top-level elements; "".join() of the result gives back the input."""
+    blocks = []
+    depth = 0
+    start = 0
+    for m in _TAG_RE.finditer(html or ""):
+        if m.group(2) is None:
+            continue  # comment
+        closing, name, attrs = m.group(1), m.group(2).lower(), m.group(3)
+        if closing:
+            depth = max(0, depth - 1)
+        elif name not in _VOID_TAGS and not attrs.rstrip().endswith("/"):
+            depth += 1
+            continue
+        if depth == 0:
+            blocks.append(html[start:m.end()])
+            start = m.end()
+    tail = (html or "")[start:]
+    if tail:
+        if blocks and not tail.strip():
+            blocks[-1] += tail
+        else:
+            blocks.append(tail)
+    return blocks
+
+def split_blocks(content, fmt):
+    if fmt == BLOCK_FORMAT_HTML:
+        return split_html_blocks(content)
+    return (content or "").split("\n")
+
+def join_blocks(texts, fmt):
+    return ("" if fmt == BLOCK_FORMAT_HTML else "\n").join(texts)
+
+def is_single_block(text, fmt):
+    return isinstance(text, str) and split_blocks(text, fmt) == [text]
+
+def doc_content(doc):
+    blocks = doc.get("blocks")
+    if isinstance(blocks, list):
+        fmt = doc.get("block_format", BLOCK_FORMAT_TEXT)
+        return join_blocks((b.get("text", "") for b in blocks), fmt)
+    return doc.get("content", "")
+
+_LINE_BREAK_RE = re.compile(
+    r"<br\s*/?>|</(?:p|h[1-6]|li|div|blockquote|pre|summary|tr)\s*>", re.I
+)
+_LIST_ITEM_RE = re.compile(r"<li(?:\s[^>]*)?>", re.I)
+
+def html_block_to_lines(block):
+    """Plain-text lines for one HTML block (list items become "- " lines)."""
+    text = _LIST_ITEM_RE.sub("- ", block)
+    text = _LINE_BREAK_RE.sub("\n", text)
+    text = _TAG_RE.sub("", text)
+    lines = [unescape(line).strip() for line in text.split("\n")]
+    # Nested closers (</p></li>) produce blank lines; keep one only for empty blocks
+    return [line for line in lines if line] or [""]
+
+def doc_paragraphs(doc):
+    """The document body as plain-text paragraphs (for exports)."""
+    blocks = doc.get("blocks")
+    if isinstance(blocks, list):
+        fmt = doc.get("block_format", BLOCK_FORMAT_TEXT)
+        texts = [b.get("text", "") for b in blocks]
+    else:
+        content = doc.get("content", "")
+        fmt = content_format(content)
+        texts = split_blocks(content, fmt)
+    if fmt != BLOCK_FORMAT_HTML:
+        return texts
+    paragraphs = []
+    for block in texts:
+        paragraphs.extend(html_block_to_lines(block))
+    return paragraphs
+
+def block_fields(content, existing=None):
+    """Fields to $set for storing `content` as blocks (ids reused from `existing`)."""
+    fmt = content_format(content)
+    return {
+        "blocks": content_to_blocks(split_blocks(content, fmt), existing),
+        "block_format": fmt,
+    }
+
+BLOCK_DIFF_MAX = int(getenv('BLOCK_DIFF_MAX', '400'))
+
+def content_to_blocks(lines, existing=None):
+    """Turn block texts into blocks, keeping the ids of unchanged/rewritten blocks from `existing`.
+
+    The common prefix/suffix is matched in linear time, so a typical autosave
+    only diffs the few blocks around the edit. SequenceMatcher is quadratic, so
+    a changed region larger than BLOCK_DIFF_MAX blocks keeps ids by position.
+    """
+    existing = existing or []
+    old = [b.get("text", "") for b in existing]
+    shortest = min(len(old), len(lines))
+    head = 0
+    while head < shortest and old[head] == lines[head]:
+        head += 1
+    tail = 0
+    while tail < shortest - head and old[-1 - tail] == lines[-1 - tail]:
+        tail += 1
+
+    old_mid = existing[head:len(existing) - tail]
+    new_mid = lines[head:len(lines) - tail]
+    if len(old_mid) + len(new_mid) <= BLOCK_DIFF_MAX:
+        opcodes = difflib.SequenceMatcher(
+            a=old[head:len(old) - tail], b=new_mid, autojunk=False
+        ).get_opcodes()
+    else:
+        opcodes = [("replace", 0, len(old_mid), 0, len(new_mid))]
+
+    blocks = [dict(b) for b in existing[:head]]
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "delete":
+            continue
+        for k in range(j2 - j1):
+            reuse = tag in ("equal", "replace") and i1 + k < i2
+            bid = old_mid[i1 + k].get("id") if reuse else new_block_id()
+            blocks.append({"id": bid, "text": new_mid[j1 + k]})
+    blocks.extend(dict(b) for b in existing[len(existing) - tail:])
+    return blocks
+
+def migrate_to_blocks(doc):
+    """Convert a legacy `content` document to blocks in place (updated_at untouched)."""
+    if isinstance(doc.get("blocks"), list):
+        return doc
+    fields = block_fields(doc.get("content", ""))
+    res = mongo.db.documents.update_one(
+        {"_id": doc["_id"], "blocks": {"$exists": False}},
+        {"$set": fields, "$unset": {"content": ""}},
+    )
+    if res.matched_count == 0:
+        # Someone else migrated it first; use their ids
+        return mongo.db.documents.find_one({"_id": doc["_id"]}) or doc
+    doc = dict(doc, **fields)
+    doc.pop("content", None)
+    return doc
+
+
+# ---------- password hashing pool ----------
+# bcrypt is deliberately slow (~100-300 ms per call), so hashing runs on a small
+# dedicated pool instead of the request thread. The bcrypt C extension releases
+# the GIL, so socket traffic keeps flowing while hashes are computed. Admission
+# is bounded: at most HASH_WORKERS running + HASH_QUEUE_LIMIT waiting, anything
+# beyond that is rejected with 503 instead of piling up.
+HASH_WORKERS = int(getenv('HASH_WORKERS', '2'))
+HASH_QUEUE_LIMIT = int(getenv('HASH_QUEUE_LIMIT', '16'))
+HASH_TIMEOUT_SECONDS = float(getenv('HASH_TIMEOUT_SECONDS', '10'))
+
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+_hash_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_LIMIT)
+
+
+class HashPoolBusy(Exception):
+    """Raised when the password hashing pool is saturated or too slow."""
+
+
+def _run_hash_job(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise HashPoolBusy("password hashing queue is full")
+    try:
+        future = _hash_pool.submit(fn, *args)
+    except Exception:
+        _hash_slots.release()
+        raise
+    # Release the slot when the job finishes, even if the caller timed out
+    future.add_done_callback(lambda _f: _hash_slots.release())
+    try:
+        return future.result(timeout=HASH_TIMEOUT_SECONDS)
+    except FutureTimeout:
+        raise HashPoolBusy("password hashing timed out")
+
+
+def hash_password(password: str) -> str:
+    return _run_hash_job(bcrypt.generate_password_hash, password).decode("utf-8")
+
+
+def check_password(hashed: str, password: str) -> bool:
+    return bool(_run_hash_job(bcrypt.check_password_hash, hashed, password))
+
+
+def retry_later_response(error, status, retry_after):
+    resp = jsonify({"error": error})
+    resp.headers["Retry-After"] = str(max(1, int(math.ceil(retry_after))))
+    return resp, status
+
+
+def hash_pool_busy_response():
+    return retry_later_response("Server busy, please retry shortly", 503, 2)
+
+
+# ---------- admission control ----------
+# Heavy endpoints (summarize, analytics, uploads, account deletion) get their own
+# small concurrency budget plus a per-team token bucket, so a burst of them is
+# shed with 503/429 instead of tying up the workers that serve autosave and
+# socket traffic. Routes without the decorator are never queued.
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(getenv('ADMISSION_QUEUE_TIMEOUT_SECONDS', '2'))
+
+# name: (max concurrent, max waiting, requests/sec per team, burst per team)
+_ADMISSION_DEFAULTS = {
+    "summarize": (2, 4, 0.5, 3),
+    "analytics": (2, 4, 1.0, 5),
+    "upload_doc": (2, 4, 0.2, 3),
+    "delete_account": (1, 0, 0.05, 1),
+}
+
+
+class AdmissionGate:
+    """Concurrency limit with a bounded, time-limited wait queue."""
+
+    def __init__(self, max_active, max_waiting):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        with self._cond:
+            if self.active < self.max_active:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                if self._cond.wait_for(lambda: self.active < self.max_active, timeout):
+                    self.active += 1
+                    return True
+                return False
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Consume one token. Returns (allowed, seconds until the next token)."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0
+        return False, (1 - self.tokens) / self.rate if self.rate > 0 else 60
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_full(self, now):
+        """A full bucket behaves exactly like a fresh one, so it can be dropped."""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def _admission_setting(name, key, default, cast):
+    return cast(getenv(f"ADMISSION_{name.upper()}_{key}", str(default)))
+
+
+_admission_gates = {}
+_admission_limits = {}
+for _name, (_active, _waiting, _rate, _burst) in _ADMISSION_DEFAULTS.items():
+    _admission_gates[_name] = AdmissionGate(
+        _admission_setting(_name, "CONCURRENCY", _active, int),
+        _admission_setting(_name, "QUEUE", _waiting, int),
+    )
+    _admission_limits[_name] = (
+        _admission_setting(_name, "RATE", _rate, float),
+        _admission_setting(_name, "BURST", _burst, int),
+    )
+ADMISSION_BUCKET_SWEEP_SECONDS = float(getenv('ADMISSION_BUCKET_SWEEP_SECONDS', '60'))
+
+_team_buckets = {}
+_team_buckets_lock = threading.Lock()
+_team_buckets_swept = time.monotonic()
+
+
+def _team_bucket(name, team, rate, burst):
+    """Get (or create) a team's bucket, evicting idle ones now and then. Caller holds the lock."""
+    global _team_buckets_swept
+    now = time.monotonic()
+    if now - _team_buckets_swept >= ADMISSION_BUCKET_SWEEP_SECONDS:
+        _team_buckets_swept = now
+        for key in [k for k, b in _team_buckets.items() if b.is_full(now)]:
+            del _team_buckets[key]
+    bucket = _team_buckets.get((name, team))
+    if bucket is None:
+        bucket = _team_buckets[(name, team)] = TokenBucket(rate, burst)
+    return bucket
+
+
+def admission_control(name):
+    """Apply the per-team rate limit and concurrency gate configured for `name`.
+
+    Must sit below @jwt_required() so the team identity is available.
+    """
+    gate = _admission_gates[name]
+    rate, burst = _admission_limits[name]
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            team = get_jwt_identity() or request.remote_addr
+            with _team_buckets_lock:
+                bucket = _team_bucket(name, team, rate, burst)
+                allowed, wait = bucket.take()
+            if not allowed:
+                return retry_later_response("Too many requests, slow down", 429, wait)
+
+            if not gate.acquire(ADMISSION_QUEUE_TIMEOUT_SECONDS):
+                # Shed for load, not for this team's rate: give the token back
+                with _team_buckets_lock:
+                    bucket.refund()
+                return retry_later_response("Server busy, please retry shortly", 503, 2)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                gate.release()
+        return wrapper
+    return decorator
+
+
 # ---------- summarization helper ----------
 def _ensure_punkt():
     """Ensure NLTK punkt resources are available (punkt + punkt_tab for NLTK>=3.8)."""
@@ -134,7 +597,10 @@ def signup():
     if mongo.db.teams.find_one({"email": email}):
         return jsonify({"error": "Team with this email already exists"}), 409
 
-    hashed_pw = bcrypt.generate_password_hash(password).decode("utf-8")
+    try:
+        hashed_pw = hash_password(password)
+    except HashPoolBusy:
+        return hash_pool_busy_response()
     mongo.db.teams.insert_one({
         "email": email,
         "password": hashed_pw,
@@ -154,8 +620,11 @@ def login():
     team = mongo.db.teams.find_one({"email": email})
     if not team or username not in team.get("usernames", []):
         return jsonify({"error": "Invalid credentials"}), 401
-    if not bcrypt.check_password_hash(team["password"], password):
-        return jsonify({"error": "Invalid credentials"}), 401
+    try:
+        if not check_password(team["password"], password):
+            return jsonify({"error": "Invalid credentials"}), 401
+    except HashPoolBusy:
+        return hash_pool_busy_response()
 
     access_token = create_access_token(identity=email)
     refresh_token = create_refresh_token(identity=email)
@@ -216,7 +685,7 @@ def create_document():
         now = datetime.now(timezone.utc)
         doc = {
             "title": data["title"].strip(),
-            "content": "",
+            **block_fields(""),
             "owner_email": email,
             "created_at": now,
             "updated_at": now
@@ -240,14 +709,55 @@ def get_document(doc_id):
         except (InvalidId, TypeError):
             return jsonify({"error": "Invalid document id"}), 400
 
+        if "offset" in request.args or "limit" in request.args:
+            return get_document_blocks(oid, email)
+
         doc = mongo.db.documents.find_one({"_id": oid, "owner_email": email})
         if not doc:
             return jsonify({"error": "Document not found"}), 404
+        doc = migrate_to_blocks(doc)
         return jsonify(serialize_doc(doc)), 200
     except Exception as e:
         print("❌ Error fetching document:", e)
         return jsonify({"error": "Failed to load document"}), 500
 
+BLOCK_PAGE_MAX = int(getenv('BLOCK_PAGE_MAX', '500'))
+
+def get_document_blocks(oid, email):
+    """Return a window of blocks (?offset=&limit=) for lazy loading in the editor."""
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "Invalid offset/limit"}), 400
+    limit = min(max(limit, 1), BLOCK_PAGE_MAX)
+
+    pipeline = [
+        {"$match": {"_id": oid, "owner_email": email}},
+        {"$project": {
+            "title": 1,
+            "updated_at": 1,
+            "has_blocks": {"$isArray": "$blocks"},
+            "total_blocks": {"$size": {"$ifNull": ["$blocks", []]}},
+            "blocks": {"$slice": [{"$ifNull": ["$blocks", []]}, offset, limit]},
+        }},
+    ]
+    rows = list(mongo.db.documents.aggregate(pipeline))
+    if rows and not rows[0]["has_blocks"]:
+        migrate_to_blocks(mongo.db.documents.find_one({"_id": oid}))
+        rows = list(mongo.db.documents.aggregate(pipeline))
+    if not rows:
+        return jsonify({"error": "Document not found"}), 404
+    row = rows[0]
+    return jsonify({
+        "id": str(oid),
+        "title": row.get("title", ""),
+        "updated_at": dt_to_iso(row.get("updated_at")),
+        "offset": offset,
+        "total_blocks": row["total_blocks"],
+        "blocks": row["blocks"],
+    }), 200
+
 # -----------------------------------------
 # UPDATE DOCUMENT
 # -----------------------------------------
@@ -263,6 +773,8 @@ def update_document(doc_id):
         if "content" not in data:
             return jsonify({"error": "Missing content"}), 400
         content = data.get("content", "")
+        if not isinstance(content, str):
+            return jsonify({"error": "Content must be a string"}), 400
         username = data.get("username") or request.headers.get("X-Username") or email
 
         try:
@@ -275,19 +787,19 @@ def update_document(doc_id):
         if not doc:
             return jsonify({"error": "Document not found"}), 404
 
-        def word_count(txt):
-            try:
-                return len((txt or "").split())
-            except Exception:
-                return 0
-
-        old_wc = word_count(doc.get("content", ""))
+        old_wc = word_count(doc_content(doc))
         new_wc = word_count(content)
         words_added = max(0, new_wc - old_wc)
 
         mongo.db.documents.update_one(
             {"_id": oid, "owner_email": email},
-            {"$set": {"content": content, "updated_at": datetime.now(timezone.utc)}}
+            {
+                "$set": {
+                    **block_fields(content, doc.get("blocks")),
+                    "updated_at": datetime.now(timezone.utc),
+                },
+                "$unset": {"content": ""},
+            }
         )
 
         # Write activity log (best-effort)
@@ -306,11 +818,349 @@ def update_document(doc_id):
         print("❌ Update error:", e)
         return jsonify({"error": "Server error"}), 500
 
+# -----------------------------------------
+# PATCH DOCUMENT (block-level edits)
+# -----------------------------------------
+PATCH_MAX_OPS = int(getenv('PATCH_MAX_OPS', '500'))
+
+def _load_block_outline(oid, email, touched_ids):
+    """Fetch block ids plus only the blocks being edited (not the whole body)."""
+    pipeline = [
+        {"$match": {"_id": oid, "owner_email": email}},
+        {"$project": {
+            "updated_at": 1,
+            "block_format": 1,
+            "has_blocks": {"$isArray": "$blocks"},
+            "block_ids": {"$ifNull": ["$blocks.id", []]},
+            "touched": {"$filter": {
+                "input": {"$ifNull": ["$blocks", []]},
+                "as": "b",
+                "cond": {"$in": ["$$b.id", touched_ids]},
+            }},
+        }},
+    ]
+    rows = list(mongo.db.documents.aggregate(pipeline))
+    if rows and not rows[0]["has_blocks"]:
+        migrate_to_blocks(mongo.db.documents.find_one({"_id": oid}))
+        rows = list(mongo.db.documents.aggregate(pipeline))
+    return rows[0] if rows else None
+
+@app.route("/documents/<doc_id>", methods=["PATCH"])
+@jwt_required()
+def patch_document(doc_id):
+    """Apply block-level edits without rewriting the whole document.
+
+    Expected payload: { ops: [...], username?, expected_updated_at? } where each op is
+      { op: "update", id, text }
+      { op: "insert", after: <block id or null for the top>, text }
+      { op: "delete", id }
+    Ops are applied in order. Block text must be exactly one block: one top-level
+    HTML element for editor documents, one line for plain-text documents. The
+    response lists the ids of inserted blocks in the order of the insert ops.
+    """
+    try:
+        email = get_jwt_identity()
+        data = request.get_json(silent=True) or {}
+        ops = data.get("ops")
+        if not isinstance(ops, list) or not ops:
+            return jsonify({"error": "Missing ops"}), 400
+        if len(ops) > PATCH_MAX_OPS:
+            return jsonify({"error": f"Too many ops (max {PATCH_MAX_OPS})"}), 413
+        if not all(isinstance(op, dict) for op in ops):
+            return jsonify({"error": "Invalid op"}), 400
+        username = data.get("username") or request.headers.get("X-Username") or email
+
+        try:
+            oid = ObjectId(doc_id)
+        except (InvalidId, TypeError):
+            return jsonify({"error": "Invalid document id"}), 400
+
+        for op in ops:
+            if op.get("op") in ("update", "delete") and not isinstance(op.get("id"), str):
+                return jsonify({"error": "Block id must be a string"}), 400
+            if op.get("op") == "insert" and not isinstance(op.get("after"), (str, type(None))):
+                return jsonify({"error": "Insert 'after' must be a block id or null"}), 400
+
+        expected = None
+        if data.get("expected_updated_at") is not None:
+            expected = parse_iso_utc(data.get("expected_updated_at"))
+            if expected is None:
+                return jsonify({"error": "Invalid expected_updated_at"}), 400
+
+        touched_ids = list({op["id"] for op in ops if op.get("op") in ("update", "delete")})
+        doc = _load_block_outline(oid, email, touched_ids)
+        if not doc:
+            return jsonify({"error": "Document not found"}), 404
+        if expected is not None:
+            if expected != parse_iso_utc(doc.get("updated_at")):
+                return jsonify({
+                    "error": "Document has changed",
+                    "updated_at": dt_to_iso(doc.get("updated_at")),
+                }), 409
+
+        # Replay the ops against the id list locally to validate them and to
+        # resolve insert positions, then apply the whole patch as one
+        # aggregation-pipeline update guarded by the updated_at we read: either
+        # every op lands or none does (MongoDB >= 4.2).
+        fmt = doc.get("block_format", BLOCK_FORMAT_TEXT)
+        ids = list(doc["block_ids"])
+        old_text = {b["id"]: b.get("text", "") for b in doc["touched"]}
+        cur_text = dict(old_text)
+        stages = []
+        inserted = {}  # id -> block literal, text filled in after all ops
+        for op in ops:
+            kind = op.get("op")
+            text = op.get("text", "")
+            if kind in ("update", "insert") and not is_single_block(text, fmt):
+                return jsonify({"error": "Block text must be a single block"}), 400
+
+            if kind == "update":
+                if op.get("id") not in ids:
+                    return jsonify({"error": f"Unknown block id: {op.get('id')}"}), 400
+                cur_text[op["id"]] = text
+            elif kind == "insert":
+                after = op.get("after")
+                if after is None:
+                    pos = 0
+                elif after in ids:
+                    pos = ids.index(after) + 1
+                else:
+                    return jsonify({"error": f"Unknown block id: {after}"}), 400
+                bid = new_block_id()
+                ids.insert(pos, bid)
+                cur_text[bid] = text
+                block = inserted[bid] = {"id": bid, "text": text}
+                # $literal keeps user text such as "$100" from being read as a field path
+                stages.append({"$set": {"blocks": {"$concatArrays": [
+                    {"$slice": ["$blocks", pos]} if pos else [],
+                    {"$literal": [block]},
+                    {"$slice": ["$blocks", pos, {"$max": [{"$size": "$blocks"}, 1]}]},
+                ]}}})
+            elif kind == "delete":
+                if op.get("id") not in ids:
+                    return jsonify({"error": f"Unknown block id: {op.get('id')}"}), 400
+                ids.remove(op["id"])
+                stages.append({"$set": {"blocks": {"$filter": {
+                    "input": "$blocks", "as": "b", "cond": {"$ne": ["$$b.id", op["id"]]},
+                }}}})
+            else:
+                return jsonify({"error": f"Unknown op: {kind}"}), 400
+
+        # Inserted blocks carry their final text; edits to existing blocks are
+        # keyed by id and applied together in the last stage.
+        live = set(ids)
+        for bid, block in inserted.items():
+            block["text"] = cur_text[bid]
+        updates = {
+            bid: t for bid, t in cur_text.items()
+            if bid in live and bid not in inserted and t != old_text.get(bid)
+        }
+        now = datetime.now(timezone.utc)
+        final = {"updated_at": now}
+        if updates:
+            final["blocks"] = {"$map": {"input": "$blocks", "as": "b", "in": {"$switch": {
+                "branches": [
+                    {
+                        "case": {"$eq": ["$$b.id", bid]},
+                        "then": {"$literal": {"id": bid, "text": t}},
+                    }
+                    for bid, t in updates.items()
+                ],
+                "default": "$$b",
+            }}}}
+        stages.append({"$set": final})
+
+        guard = {"_id": oid, "owner_email": email, "updated_at": doc.get("updated_at")}
+        res = mongo.db.documents.update_one(guard, stages)
+        if res.matched_count == 0:
+            return jsonify({"error": "Document was modified concurrently, reload and retry"}), 409
+
+        new_words = sum(word_count(t) for bid, t in cur_text.items() if bid in live)
+        old_words = sum(word_count(t) for t in old_text.values())
+        words_added = max(0, new_words - old_words)
+
+        # Write activity log (best-effort)
+        try:
+            mongo.db.activity_logs.insert_one({
+                "doc_id": str(oid),
+                "user_email": username,
+                "action": "update",
+                "timestamp": now,
+                "words_added": int(words_added),
+            })
+        except Exception as log_err:
+            print("Analytics log error:", log_err)
+
+        return jsonify({
+            "message": "Document updated",
+            "updated_at": dt_to_iso(now),
+            "inserted": list(inserted),
+        }), 200
+    except Exception as e:
+        print("❌ Patch error:", e)
+        return jsonify({"error": "Server error"}), 500
+
+# -----------------------------------------
+# BATCH UPDATE DOCUMENTS
+# -----------------------------------------
+BATCH_MAX_ITEMS = int(getenv('BATCH_MAX_ITEMS', '100'))
+# How many recent batch ids each document remembers (see batch_update_documents)
+BATCH_MARKERS_KEPT = int(getenv('BATCH_MARKERS_KEPT', '20'))
+
+@app.route("/documents/batch", methods=["POST"])
+@jwt_required()
+def batch_update_documents():
+    """Save several documents in one round trip.
+
+    Expected payload: { updates: [{ id, content, expected_updated_at? }], username? }
+    Each item is applied with optimistic concurrency: when expected_updated_at is
+    given, the write only lands if the stored updated_at still matches, otherwise
+    the item is reported as a conflict. All writes go out in a single bulk_write
+    and the activity logs in a single insert_many.
+
+    Every write also pushes this batch's id onto the document's `batch_writes`
+    (last BATCH_MARKERS_KEPT kept). When fewer writes match than were sent, that
+    marker tells which ones landed even if another writer has saved the
+    document since; documents deleted in between are reported as not_found.
+    Items the server rejected (e.g. a document over 16 MB) are reported as
+    error while the rest of the batch is still applied and logged.
+    """
+    try:
+        email = get_jwt_identity()
+        data = request.get_json(silent=True) or {}
+        updates = data.get("updates")
+        if not isinstance(updates, list) or not updates:
+            return jsonify({"error": "Missing updates"}), 400
+        if len(updates) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"Too many updates (max {BATCH_MAX_ITEMS})"}), 413
+        default_username = data.get("username") or request.headers.get("X-Username") or email
+
+        results = [None] * len(updates)
+        pending = []  # (index, oid, item)
+        seen = set()
+        for i, item in enumerate(updates):
+            raw_id = item.get("id") if isinstance(item, dict) else None
+            if not isinstance(item, dict) or "content" not in item:
+                results[i] = {"id": raw_id, "status": "invalid", "error": "Missing content"}
+                continue
+            if not isinstance(item.get("content"), str):
+                results[i] = {"id": raw_id, "status": "invalid", "error": "Content must be a string"}
+                continue
+            try:
+                oid = ObjectId(raw_id)
+            except (InvalidId, TypeError):
+                results[i] = {"id": raw_id, "status": "invalid", "error": "Invalid document id"}
+                continue
+            if oid in seen:
+                results[i] = {"id": raw_id, "status": "invalid", "error": "Duplicate document id"}
+                continue
+            seen.add(oid)
+            pending.append((i, oid, item))
+
+        # One read for every document in the batch (for word deltas + conflict checks)
+        current = {}
+        if pending:
+            cursor = mongo.db.documents.find(
+                {"_id": {"$in": [oid for _, oid, _ in pending]}, "owner_email": email},
+                {"content": 1, "blocks": 1, "block_format": 1, "updated_at": 1},
+            )
+            current = {d["_id"]: d for d in cursor}
+
+        now = parse_iso_utc(datetime.now(timezone.utc))
+        batch_id = str(ObjectId())
+        ops = []
+        applied = []  # (index, oid, words_added, username)
+        for i, oid, item in pending:
+            doc = current.get(oid)
+            if not doc:
+                results[i] = {"id": str(oid), "status": "not_found"}
+                continue
+
+            query = {"_id": oid, "owner_email": email}
+            if item.get("expected_updated_at") is not None:
+                expected = parse_iso_utc(item.get("expected_updated_at"))
+                if expected is None:
+                    results[i] = {"id": str(oid), "status": "invalid", "error": "Invalid expected_updated_at"}
+                    continue
+                if parse_iso_utc(doc.get("updated_at")) != expected:
+                    results[i] = {
+                        "id": str(oid),
+                        "status": "conflict",
+                        "updated_at": dt_to_iso(doc.get("updated_at")),
+                    }
+                    continue
+                query["updated_at"] = doc.get("updated_at")
+
+            content = item.get("content") or ""
+            words_added = max(0, word_count(content) - word_count(doc_content(doc)))
+            ops.append(UpdateOne(query, {
+                "$set": {**block_fields(content, doc.get("blocks")), "updated_at": now},
+                "$unset": {"content": ""},
+                "$push": {"batch_writes": {"$each": [batch_id], "$slice": -BATCH_MARKERS_KEPT}},
+            }))
+            applied.append((i, oid, words_added, item.get("username") or default_username))
+
+        if ops:
+            failed = set()  # indexes into ops/applied
+            try:
+                matched = mongo.db.documents.bulk_write(ops, ordered=False).matched_count
+            except BulkWriteError as bwe:
+                # Some items failed (e.g. document too large); the rest may have landed
+                print("Batch update write errors:", bwe.details.get("writeErrors"))
+                for err in bwe.details.get("writeErrors", []):
+                    failed.add(err["index"])
+                matched = bwe.details.get("nMatched", 0)
+            sent = [oid for k, (_, oid, _, _) in enumerate(applied) if k not in failed]
+            landed, existing = set(sent), set(sent)
+            if matched < len(sent):
+                # Someone else wrote or deleted between our read and the bulk
+                # write; our batch marker shows which writes landed
+                landed, existing = set(), set()
+                for d in mongo.db.documents.find(
+                    {"_id": {"$in": sent}, "owner_email": email}, {"batch_writes": 1}
+                ):
+                    existing.add(d["_id"])
+                    if batch_id in (d.get("batch_writes") or []):
+                        landed.add(d["_id"])
+
+            logs = []
+            for k, (i, oid, words_added, username) in enumerate(applied):
+                if k in failed:
+                    results[i] = {"id": str(oid), "status": "error", "error": "Write failed"}
+                    continue
+                if oid not in existing:
+                    results[i] = {"id": str(oid), "status": "not_found"}
+                    continue
+                if oid not in landed:
+                    results[i] = {"id": str(oid), "status": "conflict"}
+                    continue
+                results[i] = {"id": str(oid), "status": "updated", "updated_at": dt_to_iso(now)}
+                logs.append({
+                    "doc_id": str(oid),
+                    "user_email": username,
+                    "action": "update",
+                    "timestamp": now.replace(tzinfo=timezone.utc),
+                    "words_added": int(words_added),
+                })
+
+            # Write activity logs (best-effort)
+            if logs:
+                try:
+                    mongo.db.activity_logs.insert_many(logs, ordered=False)
+                except Exception as log_err:
+                    print("Analytics log error:", log_err)
+
+        return jsonify({"results": results}), 200
+    except Exception as e:
+        print("❌ Batch update error:", e)
+        return jsonify({"error": "Server error"}), 500
+
 # -----------------------------------------
 # ANALYTICS (team-level)
 # -----------------------------------------
 @app.route("/analytics", methods=["GET"])
 @jwt_required()
+@admission_control("analytics")
 def get_analytics():
     """Compute intelligent analytics from activity_logs for the team.
 
@@ -318,10 +1168,29 @@ def get_analytics():
     collaboration_timeline, badges, anomalies) and also a richer structure
     (contributors, collaboration_heatmap, hourly_activity, alerts,
     collaboration_matrix) for future use.
+
+    Optional query params narrow the window: from/to (ISO dates or timestamps,
+    see date_range_filter), doc_id, user, and tz (IANA name, e.g.
+    "Europe/Berlin", also read from X-Timezone). tz is used both to read from/to
+    and to bucket the hour/weekday heatmap and badges in the viewer's local time.
+    Without them the whole team history is covered in UTC, as before.
     """
     try:
         team_email = get_jwt_identity()
 
+        # Only explicit zone names need the tz database (tzdata on Windows)
+        tz_name = (request.args.get("tz") or request.headers.get("X-Timezone") or "").strip()
+        tz = timezone.utc
+        if tz_name:
+            try:
+                tz = ZoneInfo(tz_name)
+            except (ZoneInfoNotFoundError, ValueError):
+                return jsonify({"error": "Invalid timezone"}), 400
+
+        ts_range, err = date_range_filter(tz)
+        if err:
+            return jsonify({"error": err}), 400
+
         # Get this team's document IDs (as strings to match logs)
         team_docs = list(
             mongo.db.documents.find({"owner_email": team_email}, {"_id": 1})
@@ -330,10 +1199,19 @@ def get_analytics():
         if not doc_ids:
             return "", 204
 
-        # Fetch all activity logs for those docs
-        logs = list(mongo.db.activity_logs.find({"doc_id": {"$in": doc_ids}}))
-        if not logs:
-            return "", 204
+        doc_filter = request.args.get("doc_id")
+        if doc_filter and doc_filter not in doc_ids:
+            return jsonify({"error": "Document not found"}), 404
+
+        # Index-backed (doc_id, timestamp) range scan; only the fields we aggregate
+        query = {"doc_id": {"$in": [doc_filter] if doc_filter else doc_ids}}
+        if ts_range:
+            query["timestamp"] = ts_range
+        if request.args.get("user"):
+            query["user_email"] = request.args.get("user")
+        logs = mongo.db.activity_logs.find(
+            query, {"user_email": 1, "doc_id": 1, "timestamp": 1, "words_added": 1}
+        )
 
         # Helpers
         def parse_ts(ts):
@@ -356,8 +1234,6 @@ def get_analytics():
         # 7x24 matrix for heatmap [weekday][hour]
         matrix = [[0 for _ in range(24)] for _ in range(7)]
 
-        last_activity_ts = None
-
         for lg in logs:
             u = lg.get("user_email") or "unknown"
             if u not in per_user:
@@ -376,19 +1252,19 @@ def get_analytics():
 
             ts = parse_ts(lg.get("timestamp"))
             if ts:
-                # Normalize to UTC for hour/weekday
+                # Bucket hour/weekday in the requested timezone
                 if ts.tzinfo is None:
                     ts = ts.replace(tzinfo=timezone.utc)
-                ts_utc = ts.astimezone(timezone.utc)
-                hr = ts_utc.hour
-                wd = ts_utc.weekday()  # 0=Mon
+                ts_local = ts.astimezone(tz)
+                hr = ts_local.hour
+                wd = ts_local.weekday()  # 0=Mon
                 hourly_counts[hr] += 1
                 weekday_counts[wd] += 1
                 matrix[wd][hr] += 1
                 per_user[u]["hours"][hr] += 1
 
-                if last_activity_ts is None or ts > last_activity_ts:
-                    last_activity_ts = ts
+        if not per_user:
+            return "", 204
 
         # Determine badges
         # Top Contributor (highest total words)
@@ -455,7 +1331,15 @@ def get_analytics():
             for b in c["badges"]:
                 badges.append({"username": c["username"], "title": b})
 
-        # Alerts / anomalies
+        # Alerts / anomalies are about the team as a whole, not the requested
+        # window: look up the latest log via the (doc_id, timestamp) index.
+        last_activity_ts = None
+        latest = list(
+            mongo.db.activity_logs.find({"doc_id": {"$in": doc_ids}}, {"timestamp": 1})
+            .sort("timestamp", -1).limit(1)
+        )
+        if latest:
+            last_activity_ts = parse_ts(latest[0].get("timestamp"))
         alerts = []
         anomalies = []
         now = datetime.now(timezone.utc)
@@ -469,6 +1353,13 @@ def get_analytics():
             anomalies.append({"message": msg})
 
         payload = {
+            "range": {
+                "from": dt_to_iso(ts_range.get("$gte")),
+                "to": dt_to_iso(ts_range.get("$lt") or ts_range.get("$lte")),
+                "doc_id": doc_filter,
+                "user": request.args.get("user"),
+                "timezone": tz_name or "UTC",
+            },
             # Rich structure
             "contributors": contributors,
             "collaboration_heatmap": collaboration_heatmap,
@@ -515,6 +1406,7 @@ def reset_analytics():
 # -----------------------------------------
 @app.route('/upload_doc', methods=['POST'])
 @jwt_required()
+@admission_control("upload_doc")
 def upload_doc():
     try:
         try:
@@ -560,7 +1452,7 @@ def upload_doc():
         now = datetime.now(timezone.utc)
         new_doc = {
             "title": os.path.splitext(filename)[0],
-            "content": text or "",
+            **block_fields(text or ""),
             "owner_email": user,
             "created_at": now,
             "updated_at": now,
@@ -571,6 +1463,212 @@ def upload_doc():
         print("Upload doc error:", e)
         return jsonify({"error": f"Failed to upload document: {e}"}), 500
 
+# -----------------------------------------
+# EXPORT (streaming, team-wide)
+# -----------------------------------------
+EXPORT_BATCH_SIZE = int(getenv('EXPORT_BATCH_SIZE', '100'))
+
+
+class _StreamBuffer:
+    """Write-only, non-seekable sink that lets zipfile emit into a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _export_filters(ts_field):
+    """Build the Mongo filter for from/to/after query params.
+
+    `after` is the last id the client received; passing it back resumes an
+    interrupted export from the next record (results are ordered by _id).
+    Returns (filter, error_message).
+    """
+    query = {}
+    date_range, err = date_range_filter()
+    if err:
+        return None, err
+    if date_range:
+        query[ts_field] = date_range
+
+    after = request.args.get("after")
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except (InvalidId, TypeError):
+            return None, "Invalid 'after' id"
+    return query, None
+
+
+def _docx_bytes(docx_cls, title, paragraphs):
+    d = docx_cls()
+    if title:
+        d.add_heading(title, level=1)
+    for line in paragraphs:
+        d.add_paragraph(line)
+    out = io.BytesIO()
+    d.save(out)
+    return out.getvalue()
+
+
+def _attachment(filename):
+    return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+
+@app.route("/export/documents", methods=["GET"])
+@jwt_required()
+def export_documents():
+    """Stream all team documents as a zip of .txt (default) or .docx files.
+
+    Query params: format=txt|docx, from, to (ISO dates on updated_at), after (resume id).
+    Documents are read from a cursor and written into the zip one at a time, so
+    memory stays flat regardless of how many documents the team has. An error
+    mid-stream aborts the connection rather than ending the zip cleanly, so a
+    client never mistakes a partial archive for a complete one.
+    """
+    try:
+        email = get_jwt_identity()
+        fmt = (request.args.get("format") or "txt").strip().lower()
+        if fmt not in {"txt", "docx"}:
+            return jsonify({"error": "Unsupported format"}), 400
+        docx_cls = None
+        if fmt == "docx":
+            try:
+                from docx import Document as DocxDocument
+            except Exception:
+                return jsonify({
+                    "error": "python-docx is not installed. Run: pip install python-docx"
+                }), 500
+            docx_cls = DocxDocument
+
+        query, err = _export_filters("updated_at")
+        if err:
+            return jsonify({"error": err}), 400
+        query["owner_email"] = email
+
+        def generate():
+            buf = _StreamBuffer()
+            cursor = mongo.db.documents.find(
+                query, {"title": 1, "content": 1, "blocks.text": 1, "block_format": 1}
+            ).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+            try:
+                with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                    for doc in cursor:
+                        title = doc.get("title", "")
+                        base = secure_filename(title) or "untitled"
+                        name = f"{base}-{doc['_id']}.{fmt}"
+                        if docx_cls:
+                            data = _docx_bytes(docx_cls, title, doc_paragraphs(doc))
+                        else:
+                            data = "\n".join(doc_paragraphs(doc)).encode("utf-8")
+                        zf.writestr(name, data)
+                        yield buf.drain()
+                yield buf.drain()
+            except Exception as e:
+                # Re-raise so the server drops the connection instead of finishing the body
+                print("Export documents error:", e)
+                raise
+            finally:
+                cursor.close()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="application/zip",
+            headers=_attachment("documents.zip"),
+        )
+    except Exception as e:
+        print("Export documents error:", e)
+        return jsonify({"error": "Failed to export documents"}), 500
+
+
+@app.route("/export/activity", methods=["GET"])
+@jwt_required()
+def export_activity():
+    """Stream the team's activity logs as NDJSON (default) or CSV.
+
+    Query params: format=ndjson|csv, from, to (ISO dates on timestamp), after (resume id).
+    Every record carries its id so a dropped download can resume with ?after=<last id>.
+    NDJSON ends with an {"end": true, "count": n} line; a stream without it is
+    incomplete. An error mid-stream aborts the connection (both formats), so a
+    truncated CSV fails as a transfer error instead of looking complete.
+    """
+    try:
+        team_email = get_jwt_identity()
+        fmt = (request.args.get("format") or "ndjson").strip().lower()
+        if fmt not in {"ndjson", "csv"}:
+            return jsonify({"error": "Unsupported format"}), 400
+
+        query, err = _export_filters("timestamp")
+        if err:
+            return jsonify({"error": err}), 400
+        doc_ids = [
+            str(d["_id"])
+            for d in mongo.db.documents.find({"owner_email": team_email}, {"_id": 1})
+        ]
+        query["doc_id"] = {"$in": doc_ids}
+
+        columns = ["id", "doc_id", "user_email", "action", "timestamp", "words_added"]
+
+        def row(lg):
+            return {
+                "id": str(lg["_id"]),
+                "doc_id": lg.get("doc_id"),
+                "user_email": lg.get("user_email"),
+                "action": lg.get("action"),
+                "timestamp": dt_to_iso(lg.get("timestamp")),
+                "words_added": int(lg.get("words_added", 0) or 0),
+            }
+
+        def generate():
+            cursor = mongo.db.activity_logs.find(query).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+            try:
+                if fmt == "csv":
+                    line = io.StringIO()
+                    writer = csv.DictWriter(line, fieldnames=columns)
+                    writer.writeheader()
+                    for lg in cursor:
+                        writer.writerow(row(lg))
+                        yield line.getvalue()
+                        line.seek(0)
+                        line.truncate(0)
+                    yield line.getvalue()
+                else:
+                    count = 0
+                    for lg in cursor:
+                        count += 1
+                        yield json.dumps(row(lg)) + "\n"
+                    yield json.dumps({"end": True, "count": count}) + "\n"
+            except Exception as e:
+                # Re-raise so the server drops the connection instead of finishing the body
+                print("Export activity error:", e)
+                raise
+            finally:
+                cursor.close()
+
+        if fmt == "csv":
+            mimetype, filename = "text/csv", "activity_logs.csv"
+        else:
+            mimetype, filename = "application/x-ndjson", "activity_logs.ndjson"
+        return Response(
+            stream_with_context(generate()),
+            mimetype=mimetype,
+            headers=_attachment(filename),
+        )
+    except Exception as e:
+        print("Export activity error:", e)
+        return jsonify({"error": "Failed to export activity"}), 500
+
 # -----------------------------------------
 # DELETE DOCUMENT
 # -----------------------------------------
@@ -605,6 +1703,7 @@ def delete_document(doc_id):
 # -----------------------------------------
 @app.route("/summarize", methods=["POST"])
 @jwt_required()
+@admission_control("summarize")
 def summarize_route():
     try:
         data = request.get_json(silent=True) or {}
@@ -641,15 +1740,17 @@ def change_password():
         team = mongo.db.teams.find_one({"email": email})
         if not team:
             return jsonify({"error": "Account not found"}), 404
-        if not bcrypt.check_password_hash(team.get("password", ""), current_password):
+        if not check_password(team.get("password", ""), current_password):
             return jsonify({"error": "Current password is incorrect"}), 401
 
-        hashed_new = bcrypt.generate_password_hash(new_password).decode("utf-8")
+        hashed_new = hash_password(new_password)
         mongo.db.teams.update_one(
             {"_id": team["_id"]},
             {"$set": {"password": hashed_new, "updated_at": datetime.now(timezone.utc)}}
         )
         return jsonify({"message": "Password updated successfully"}), 200
+    except HashPoolBusy:
+        return hash_pool_busy_response()
     except Exception as e:
         print("Change password error:", e)
         return jsonify({"error": "Failed to update password"}), 500
@@ -741,6 +1842,7 @@ def remove_member():
 # -----------------------------------------
 @app.route("/delete_account", methods=["DELETE"])
 @jwt_required()
+@admission_control("delete_account")
 def delete_account():
     try:
         email = get_jwt_identity()
@@ -775,46 +1877,301 @@ def delete_account():
         print("Delete account error:", e)
         return jsonify({"error": "Failed to delete account"}), 500
 
+# -----------------------------------------
+# PROFILING (opt-in, admins only)
+# -----------------------------------------
+# - Slow requests/socket handlers (>= SLOW_REQUEST_MS; 0/off by default, e.g.
+#   1000 to enable) are logged with a breakdown of the Mongo commands they ran.
+# - An admin listed in PROFILE_ADMIN_EMAILS can send `X-Profile: 1` to capture a
+#   cProfile of that single request (.prof, open with pstats/snakeviz).
+# - POST /admin/profiler starts a sampling profiler for a time window and writes
+#   collapsed stacks (flamegraph.pl / speedscope format).
+# Everything is written to PROFILE_DIR.
+PROFILE_DIR = getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_ADMINS = {e.strip().lower() for e in getenv('PROFILE_ADMIN_EMAILS', '').split(',') if e.strip()}
+SLOW_REQUEST_MS = float(getenv('SLOW_REQUEST_MS', '0'))
+SAMPLER_MAX_SECONDS = int(getenv('SAMPLER_MAX_SECONDS', '300'))
+
+
+def _profile_path(prefix, ext):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return os.path.join(PROFILE_DIR, f"{secure_filename(prefix) or 'profile'}-{stamp}.{ext}")
+
+
+def _begin_query_trace():
+    if SLOW_REQUEST_MS > 0:
+        _query_trace.calls = []
+        _query_trace.pending = {}
+
+
+def _end_query_trace(label, elapsed_ms):
+    calls = getattr(_query_trace, "calls", None)
+    _query_trace.calls = None
+    if SLOW_REQUEST_MS <= 0 or elapsed_ms < SLOW_REQUEST_MS:
+        return
+    totals = defaultdict(lambda: [0, 0.0])
+    for target, ms in calls or []:
+        totals[target][0] += 1
+        totals[target][1] += ms
+    breakdown = sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True)[:10]
+    db_ms = sum(t[1] for t in totals.values())
+    print(f"Slow {label}: {elapsed_ms:.0f} ms (mongo {db_ms:.0f} ms in {len(calls or [])} queries)")
+    for target, (count, ms) in breakdown:
+        print(f"    {target}: {count}x {ms:.1f} ms")
+
+
+def _is_profile_admin():
+    try:
+        verify_jwt_in_request(optional=True)
+        return (get_jwt_identity() or "").strip().lower() in PROFILE_ADMINS
+    except Exception:
+        return False
+
+
+@app.before_request
+def _start_request_profiling():
+    g.request_started = time.perf_counter()
+    g.profiler = None
+    _begin_query_trace()
+    if request.headers.get("X-Profile") and PROFILE_ADMINS and _is_profile_admin():
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            g.profiler = profiler
+        except Exception as e:
+            # e.g. another profile is already running
+            print("Request profiler error:", e)
+
+
+@app.after_request
+def _name_request_profile(response):
+    # Only pick the file name here; the profile is stopped and written in
+    # teardown, which also runs when the view raises.
+    if g.get("profiler") is not None:
+        g.profile_path = _profile_path(f"request-{request.endpoint}", "prof")
+        response.headers["X-Profile-File"] = os.path.basename(g.profile_path)
+    return response
+
+
+@app.teardown_request
+def _finish_request_profiling(exc):
+    started = g.get("request_started")
+    if started is None:
+        return
+    profiler = g.get("profiler")
+    if profiler is not None:
+        g.profiler = None
+        profiler.disable()
+        try:
+            path = g.get("profile_path") or _profile_path(f"request-{request.endpoint}", "prof")
+            profiler.dump_stats(path)
+        except Exception as e:
+            print("Request profiler error:", e)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    status = " (failed)" if exc is not None else ""
+    _end_query_trace(f"request {request.method} {request.path}{status}", elapsed_ms)
+
+
+def traced_socket_handler(fn):
+    """Slow-handler logging (with Mongo breakdown) for socket events."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        _begin_query_trace()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _end_query_trace(f"socket {fn.__name__}", (time.perf_counter() - started) * 1000)
+    return wrapper
+
+
+class SamplingProfiler:
+    """Periodically samples every thread's stack; near-zero cost when idle."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.path = None
+        self.until = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval):
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self.path = _profile_path("sampler", "collapsed")
+            self.until = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+            self._thread = threading.Thread(
+                target=self._run, args=(seconds, interval, self.path), name="sampler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, seconds, interval, path):
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self._stop.is_set():
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks[";".join(reversed(names))] += 1
+            time.sleep(interval)
+        try:
+            with open(path, "w", encoding="utf-8") as fh:
+                for stack, count in stacks.most_common():
+                    fh.write(f"{stack} {count}\n")
+        except Exception as e:
+            print("Sampling profiler error:", e)
+
+
+sampler = SamplingProfiler()
+
+
+@app.route("/admin/profiler", methods=["GET", "POST", "DELETE"])
+@jwt_required()
+def admin_profiler():
+    """GET: status. POST { seconds?, interval_ms? }: start sampling. DELETE: stop early."""
+    try:
+        if not _is_profile_admin():
+            return jsonify({"error": "Forbidden"}), 403
+
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            try:
+                seconds = min(max(int(data.get("seconds", 30)), 1), SAMPLER_MAX_SECONDS)
+                interval = min(max(float(data.get("interval_ms", 10)), 1.0), 1000.0) / 1000.0
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid seconds/interval_ms"}), 400
+            if not sampler.start(seconds, interval):
+                return jsonify({"error": "Profiler already running"}), 409
+        elif request.method == "DELETE":
+            sampler.stop()
+
+        return jsonify({
+            "running": sampler.running,
+            "file": os.path.basename(sampler.path) if sampler.path else None,
+            "until": dt_to_iso(sampler.until),
+        }), 202 if request.method == "POST" else 200
+    except Exception as e:
+        print("Profiler error:", e)
+        return jsonify({"error": "Profiler error"}), 500
+
 # -----------------------------------------
 # SOCKET EVENTS
 # -----------------------------------------
 
+# Each client picks a wire encoding at join_doc (see collab_codec). Clients of the
+# same document are split into one room per encoding, and every broadcast is
+# encoded once per encoding in use, so JSON-only clients keep working unchanged.
+COLLAB_COMPRESS_MIN_BYTES = int(getenv('COLLAB_COMPRESS_MIN_BYTES', str(collab_codec.COMPRESS_MIN_BYTES)))
+
+_collab_lock = threading.Lock()
+_room_encodings = defaultdict(Counter)  # doc_id -> {encoding: client count}
+_sid_docs = defaultdict(dict)  # sid -> {doc_id: encoding}
+
+def _collab_room(doc_id, encoding):
+    return doc_id if encoding == collab_codec.JSON else f"{doc_id}#{encoding}"
+
+def _track_join(sid, doc_id, encoding):
+    with _collab_lock:
+        previous = _sid_docs[sid].get(doc_id)
+        if previous:
+            _room_encodings[doc_id][previous] -= 1
+        _sid_docs[sid][doc_id] = encoding
+        _room_encodings[doc_id][encoding] += 1
+    return previous
+
+def _track_leave(sid, doc_id):
+    with _collab_lock:
+        encoding = _sid_docs.get(sid, {}).pop(doc_id, None)
+        if encoding:
+            _room_encodings[doc_id][encoding] -= 1
+            if not +_room_encodings[doc_id]:
+                _room_encodings.pop(doc_id, None)
+        if sid in _sid_docs and not _sid_docs[sid]:
+            _sid_docs.pop(sid, None)
+    return encoding
+
+def broadcast_collab(event, payload, doc_id):
+    """Emit to everyone else in the document, once per negotiated encoding."""
+    with _collab_lock:
+        encodings = {e for e, n in _room_encodings.get(doc_id, {}).items() if n > 0}
+    encodings.add(collab_codec.JSON)
+    for encoding in encodings:
+        emit(
+            event,
+            collab_codec.encode(payload, encoding, COLLAB_COMPRESS_MIN_BYTES),
+            to=_collab_room(doc_id, encoding),
+            skip_sid=request.sid,
+        )
+
 @socketio.on("join_doc")
+@traced_socket_handler
 def on_join_doc(data):
+    """Join a document room.
+    Expected payload: { doc_id, user, encoding? } where encoding is "json" (default)
+    or "msgpack". The ack returns the encoding the server will actually use.
+    """
     try:
+        data = collab_codec.decode(data)
         doc_id = (data or {}).get("doc_id")
         user = (data or {}).get("user")
         if not doc_id:
             return
-        join_room(doc_id)
-        emit("presence", {"event": "join", "user": user}, to=doc_id, include_self=False)
+        encoding = collab_codec.negotiate((data or {}).get("encoding"))
+        previous = _track_join(request.sid, doc_id, encoding)
+        if previous and previous != encoding:
+            leave_room(_collab_room(doc_id, previous))
+        join_room(_collab_room(doc_id, encoding))
+        broadcast_collab("presence", {"event": "join", "user": user}, doc_id)
+        return {"encoding": encoding}
     except Exception as e:
         print("join_doc error:", e)
 
 @socketio.on("leave_doc")
+@traced_socket_handler
 def on_leave_doc(data):
     try:
+        data = collab_codec.decode(data)
         doc_id = (data or {}).get("doc_id")
         user = (data or {}).get("user")
         if not doc_id:
             return
-        leave_room(doc_id)
-        emit("presence", {"event": "leave", "user": user}, to=doc_id, include_self=False)
+        encoding = _track_leave(request.sid, doc_id) or collab_codec.JSON
+        leave_room(_collab_room(doc_id, encoding))
+        broadcast_collab("presence", {"event": "leave", "user": user}, doc_id)
     except Exception as e:
         print("leave_doc error:", e)
 
 @socketio.on("doc_change")
+@traced_socket_handler
 def on_doc_change(data):
     """Broadcast document content changes to other clients in the room.
-    Expected payload: { doc_id, content, client_id }
+    Expected payload: { doc_id, content, client_id }, as JSON or msgpack-encoded.
     """
     try:
+        data = collab_codec.decode(data)
         doc_id = (data or {}).get("doc_id")
         content = (data or {}).get("content", "")
         client_id = (data or {}).get("client_id")
         if not doc_id:
             return
-        emit("doc_update", {"content": content, "client_id": client_id}, to=doc_id, include_self=False)
+        broadcast_collab("doc_update", {"content": content, "client_id": client_id}, doc_id)
     except Exception as e:
         print("doc_change error:", e)
 
@@ -824,12 +2181,26 @@ def on_connect():
 
 @socketio.on("disconnect")
 def on_disconnect():
+    for doc_id in list(_sid_docs.get(request.sid, {})):
+        _track_leave(request.sid, doc_id)
     print("Client disconnected ❌")
 
+# -----------------------------------------
+# INDEXES
+# -----------------------------------------
+def ensure_indexes():
+    """Create the indexes the hot queries rely on (idempotent, best-effort)."""
+    try:
+        mongo.db.activity_logs.create_index([("doc_id", 1), ("timestamp", 1)])
+        mongo.db.documents.create_index([("owner_email", 1)])
+    except Exception as e:
+        print("Index setup error:", e)
+
 # -----------------------------------------
 # MAIN
 # -----------------------------------------
 if __name__ == "__main__":
+    ensure_indexes()
     # Bind host/port from env for flexibility
     host = getenv("HOST", "127.0.0.1")
     try:
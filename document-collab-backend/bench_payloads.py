@@ -0,0 +1,71 @@
+"""Compare bytes-per-update and CPU cost of the collaboration payload encodings.
+
+Usage: python bench_payloads.py [iterations]
+
+"json" is what Socket.IO puts on the wire today, "json+zlib" approximates a
+deflate-compressed websocket frame, and the msgpack rows are what
+collab_codec.encode() produces for clients that negotiate "msgpack".
+"""
+import json
+import random
+import sys
+import time
+import zlib
+
+import collab_codec
+
+WORDS = (
+    "the team reviewed draft section budget timeline release editor document "
+    "notes meeting client update change summary analytics paragraph version"
+).split()
+
+
+def sample_content(size):
+    rnd = random.Random(size)
+    lines, total = [], 0
+    while total < size:
+        line = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(6, 18))).capitalize() + "."
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def timed(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        out = fn()
+    return out, (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    codecs = [
+        ("json", lambda p: json.dumps(p).encode("utf-8"),
+         lambda b: json.loads(b.decode("utf-8"))),
+        ("json+zlib", lambda p: zlib.compress(json.dumps(p).encode("utf-8"), collab_codec.COMPRESS_LEVEL),
+         lambda b: json.loads(zlib.decompress(b).decode("utf-8"))),
+    ]
+    if collab_codec.msgpack is not None:
+        codecs += [
+            ("msgpack", lambda p: collab_codec.encode(p, collab_codec.MSGPACK, compress_min_bytes=None),
+             collab_codec.decode),
+            ("msgpack+zlib", lambda p: collab_codec.encode(p, collab_codec.MSGPACK),
+             collab_codec.decode),
+        ]
+    else:
+        print("msgpack is not installed; only JSON rows are shown\n")
+
+    print(f"{'doc size':>9}  {'encoding':<13} {'bytes':>9} {'ratio':>6} {'encode us':>10} {'decode us':>10}")
+    for size in (256, 2 * 1024, 16 * 1024, 128 * 1024):
+        payload = {"content": sample_content(size), "client_id": "c0ffee-1234"}
+        baseline = None
+        for name, enc, dec in codecs:
+            data, enc_us = timed(lambda: enc(payload), iterations)
+            _, dec_us = timed(lambda: dec(data), iterations)
+            baseline = baseline or len(data)
+            print(f"{size:>9}  {name:<13} {len(data):>9} {len(data) / baseline:>6.2f} {enc_us:>10.1f} {dec_us:>10.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
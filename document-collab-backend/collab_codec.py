@@ -0,0 +1,61 @@
+"""Wire encodings for the collaboration socket events (doc_update, doc_change, presence).
+
+The encoding is negotiated per client at join_doc:
+  "json"    - plain Socket.IO JSON events; the default and what older clients speak.
+  "msgpack" - one binary argument: a flag byte followed by a msgpack map. When the
+              flag is FLAG_ZLIB the map is zlib-deflated (used for large payloads).
+"""
+import zlib
+
+try:
+    import msgpack  # type: ignore
+except Exception:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+FLAG_RAW = 0
+FLAG_ZLIB = 1
+
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 1  # live edits favour speed; see bench_payloads.py
+MAX_DECODED_BYTES = 16 * 1024 * 1024
+
+
+def available_encodings():
+    return (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+def negotiate(requested):
+    """Pick the encoding for a client, falling back to JSON when unsupported."""
+    requested = (requested or JSON).strip().lower() if isinstance(requested, str) else JSON
+    return requested if requested in available_encodings() else JSON
+
+
+def encode(payload, encoding, compress_min_bytes=COMPRESS_MIN_BYTES, level=COMPRESS_LEVEL):
+    if encoding != MSGPACK:
+        return payload
+    body = msgpack.packb(payload, use_bin_type=True)
+    if compress_min_bytes is not None and len(body) >= compress_min_bytes:
+        packed = zlib.compress(body, level)
+        if len(packed) < len(body):
+            return bytes([FLAG_ZLIB]) + packed
+    return bytes([FLAG_RAW]) + body
+
+
+def decode(data):
+    """Turn an incoming event argument back into a dict (JSON args pass through)."""
+    if not isinstance(data, (bytes, bytearray)):
+        return data
+    if not data or msgpack is None:
+        return {}
+    flag, body = data[0], bytes(data[1:])
+    if flag == FLAG_ZLIB:
+        inflater = zlib.decompressobj()
+        body = inflater.decompress(body, MAX_DECODED_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError("Decoded payload too large")
+    elif flag != FLAG_RAW:
+        raise ValueError(f"Unknown payload flag: {flag}")
+    return msgpack.unpackb(body, raw=False)